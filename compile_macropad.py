@@ -66,10 +66,9 @@ def compile_macro(macro: dict[str, Any], slot: int) -> str:
     return '; '.join(parts)
 
 
-def generate_macros(config: dict[str, Any]) -> list[tuple[int, str, str]]:
-    """Generate macro definitions. Returns list of (slot, vitaly_command, description)."""
-    macros = []
-    device_id = config['device_id']
+def assign_macro_slots(config: dict[str, Any]) -> list[tuple[int, dict[str, Any]]]:
+    """Assign device slots to macros. Returns list of (slot, macro) sorted by slot."""
+    slotted = []
     defined_macros = config.get('macros', [])
     used_ids = set()
 
@@ -80,8 +79,7 @@ def generate_macros(config: dict[str, Any]) -> list[tuple[int, str, str]]:
             if slot in used_ids:
                 raise ValueError(f"Duplicate macro slot: {slot}")
             used_ids.add(slot)
-            vitaly_cmd = f"vitaly -i {device_id} macros -n {slot} -v '{compile_macro(macro, slot)}'"
-            macros.append((slot, vitaly_cmd, macro.get('description', '')))
+            slotted.append((slot, macro))
 
     # Second pass: assign IDs to macros without explicit IDs
     next_id = 0
@@ -91,11 +89,22 @@ def generate_macros(config: dict[str, Any]) -> list[tuple[int, str, str]]:
                 next_id += 1
             slot = next_id
             used_ids.add(slot)
-            vitaly_cmd = f"vitaly -i {device_id} macros -n {slot} -v '{compile_macro(macro, slot)}'"
-            macros.append((slot, vitaly_cmd, macro.get('description', '')))
+            slotted.append((slot, macro))
             next_id += 1
 
-    return sorted(macros, key=lambda x: x[0])
+    return sorted(slotted, key=lambda x: x[0])
+
+
+def generate_macros(config: dict[str, Any]) -> list[tuple[int, str, str]]:
+    """Generate macro definitions. Returns list of (slot, vitaly_command, description)."""
+    macros = []
+    device_id = config['device_id']
+
+    for slot, macro in assign_macro_slots(config):
+        vitaly_cmd = f"vitaly -i {device_id} macros -n {slot} -v '{compile_macro(macro, slot)}'"
+        macros.append((slot, vitaly_cmd, macro.get('description', '')))
+
+    return macros
 
 
 def generate_keys(config: dict[str, Any]) -> list[tuple[str, str, str]]:
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Local snapshots of macropad device state.
+Keeps the last known keys, encoders and macros of each device, keyed by
+device serial, so that:
+- plan: shows pending changes for a config without touching the device
+- deploy: flashes a config and records the new state on success
+- verify: checks a config against the snapshot (or the device with --full)
+"""
+
+import argparse
+import json
+import re
+import subprocess
+import sys
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from compile_macropad import (
+    assign_macro_slots,
+    compile_macro,
+    generate_encoders,
+    generate_keys,
+    generate_macros,
+    generate_shell_script,
+    load_yaml,
+    validate_config,
+)
+
+DEFAULT_STATE_DIR = Path('.macropad-state')
+VITALY_TIMEOUT = 30  # seconds; a full layer read over HID is the slowest call
+DEVICES_TIMEOUT = 5  # seconds; serial lookup must not stall plan
+
+_LAYER_RE = re.compile(r'^layer\s*:?\s*(\d+)\b', re.IGNORECASE)
+_ENCODER_RE = re.compile(r'^encoder\s*:?\s*(\d+)\b', re.IGNORECASE)
+_DIRECTION_RE = re.compile(r'\b(ccw|cw)\s*[:=]\s*([^\s;]+)', re.IGNORECASE)
+_CELL_SEPARATOR_RE = re.compile(r'[│┃║|]+')
+_POSITION_RE = re.compile(r'^(\d+)\s*,\s*(\d+)$')
+_DEVICE_FIELD_RE = re.compile(r'\bid\s*[:=]', re.IGNORECASE)
+_SERIAL_RE = re.compile(r'(vial:[0-9A-Za-z]+)|serial\s*[:=]\s*"?([^\s",]+)', re.IGNORECASE)
+_MACRO_ALIAS_RE = re.compile(r'\b(?:QK_MACRO_|MACRO_)(\d+)\b|\bMACRO\((\d+)\)')
+_IDENTIFIER_RE = re.compile(r'\b[A-Za-z_]\w*\b')
+_MODIFIER_ALIAS_RE = re.compile(r'\b(C|S|A|G|LOPT|LCMD|LWIN)\(')
+
+# Long and short spellings of the same keycode, mapped to the form the YAML uses
+KEYCODE_ALIASES = {
+    '_______': 'KC_TRNS',
+    'KC_TRANSPARENT': 'KC_TRNS',
+    'XXXXXXX': 'KC_NO',
+    'KC_ESCAPE': 'KC_ESC',
+    'KC_SPACE': 'KC_SPC',
+    'KC_ENTER': 'KC_ENT',
+    'KC_BACKSPACE': 'KC_BSPC',
+    'KC_BSPACE': 'KC_BSPC',
+    'KC_DELETE': 'KC_DEL',
+    'KC_AUDIO_VOL_UP': 'KC_VOLU',
+    'KC_AUDIO_VOL_DOWN': 'KC_VOLD',
+    'KC_AUDIO_MUTE': 'KC_MUTE',
+    'KC_MS_WH_UP': 'KC_WH_U',
+    'KC_MS_WH_DOWN': 'KC_WH_D',
+}
+MODIFIER_ALIASES = {
+    'C': 'LCTL',
+    'S': 'LSFT',
+    'A': 'LALT',
+    'LOPT': 'LALT',
+    'G': 'LGUI',
+    'LCMD': 'LGUI',
+    'LWIN': 'LGUI',
+}
+
+
+def empty_state() -> dict[str, Any]:
+    """Return a state with no layers and no macros."""
+    return {'layers': {}, 'macros': {}}
+
+
+def _layer_state(state: dict[str, Any], layer: int | str) -> dict[str, dict[str, str]]:
+    return state['layers'].setdefault(str(layer), {'keys': {}, 'encoders': {}})
+
+
+def config_state(config: dict[str, Any]) -> dict[str, Any]:
+    """Build the device state a config would produce once deployed."""
+    state = empty_state()
+
+    for layer in config['layers']:
+        layer_state = _layer_state(state, layer['index'])
+        for key in layer.get('keys', []):
+            layer_state['keys'][f"{key['row']},{key['col']}"] = str(key['value'])
+        for encoder in layer.get('encoders', []):
+            for direction in ['cw', 'ccw']:
+                if direction in encoder:
+                    dir_idx = 1 if direction == 'cw' else 0
+                    layer_state['encoders'][f"{encoder['encoder']},{dir_idx}"] = str(encoder[direction])
+
+    for slot, macro in assign_macro_slots(config):
+        state['macros'][str(slot)] = compile_macro(macro, slot)
+
+    return state
+
+
+def normalize_keycode(value: str) -> str:
+    """Reduce a keycode to one canonical spelling, e.g. QK_MACRO_0 -> M0, C(KC_A) -> LCTL(KC_A)."""
+    value = re.sub(r'\s+', '', value)
+    value = _MACRO_ALIAS_RE.sub(lambda m: f"M{m.group(1) or m.group(2)}", value)
+    value = _MODIFIER_ALIAS_RE.sub(lambda m: f"{MODIFIER_ALIASES[m.group(1)]}(", value)
+    return _IDENTIFIER_RE.sub(lambda m: KEYCODE_ALIASES.get(m.group(), m.group()), value)
+
+
+def diff_states(current: dict[str, Any], desired: dict[str, Any]) -> list[tuple[str, str, str, str | None, str]]:
+    """Compare desired entries against current state.
+
+    Only entries present in ``desired`` are compared, since a deploy leaves
+    everything else on the device untouched. Keys and encoders are compared
+    after normalize_keycode.
+    Returns list of (kind, layer, position, old_value, new_value); layer is '' for macros.
+    """
+    changes = []
+
+    for layer_idx, layer in sorted(desired['layers'].items(), key=lambda x: int(x[0])):
+        current_layer = current['layers'].get(layer_idx, {})
+        for kind in ['keys', 'encoders']:
+            current_values = current_layer.get(kind, {})
+            for position, value in sorted(layer.get(kind, {}).items()):
+                old = current_values.get(position)
+                if old is None or normalize_keycode(old) != normalize_keycode(value):
+                    changes.append((kind[:-1], layer_idx, position, old, value))
+
+    for slot, value in sorted(desired['macros'].items(), key=lambda x: int(x[0])):
+        old = current['macros'].get(slot)
+        if old != value:
+            changes.append(('macro', '', slot, old, value))
+
+    return changes
+
+
+def format_changes(changes: list[tuple[str, str, str, str | None, str]]) -> str:
+    """Render changes as one line each: '+' for new entries, '~' for modified ones."""
+    lines = []
+    for kind, layer, position, old, new in changes:
+        marker = '+' if old is None else '~'
+        where = f"macro {position}" if kind == 'macro' else f"layer {layer} {kind} {position}"
+        if old is None:
+            lines.append(f"  {marker} {where}: {new}")
+        else:
+            lines.append(f"  {marker} {where}: {old} -> {new}")
+    return "\n".join(lines)
+
+
+def find_drift(snapshot: dict[str, Any], device: dict[str, Any]) -> list[tuple[str, str, str, str, str | None]]:
+    """Compare the keys and encoders recorded in a snapshot against a device read.
+
+    Returns list of (kind, layer, position, snapshot_value, device_value);
+    device_value is None when the device read lacks the entry.
+    """
+    recorded = {'layers': snapshot['layers'], 'macros': {}}
+    return [(kind, layer, position, new, old) for kind, layer, position, old, new in diff_states(device, recorded)]
+
+
+def format_drift(drift: list[tuple[str, str, str, str, str | None]]) -> str:
+    """Render drift as one line each: '-' for entries missing on the device, '~' for changed ones."""
+    lines = []
+    for kind, layer, position, recorded, actual in drift:
+        where = f"layer {layer} {kind} {position}"
+        if actual is None:
+            lines.append(f"  - {where}: {recorded} (missing on device)")
+        else:
+            lines.append(f"  ~ {where}: {recorded} -> {actual}")
+    return "\n".join(lines)
+
+
+# ---------------------------------------------------------------------------
+# Device dump parsing
+# ---------------------------------------------------------------------------
+
+def _flush_row(band: list[list[str]], row_idx: int, keys: dict[str, str]) -> None:
+    """Record the keys of one physical row made of one or more text lines."""
+    cols = max(len(cells) for cells in band)
+    for col in range(cols):
+        texts = [cells[col].strip() for cells in band if col < len(cells) and cells[col].strip()]
+        position = next((t for t in texts if _POSITION_RE.match(t)), None)
+        value = next((t for t in texts if not _POSITION_RE.match(t)), None)
+        if value is None:
+            continue
+        if position is not None:
+            row, col_label = _POSITION_RE.match(position).groups()
+            position = f"{row},{col_label}"
+        keys[position or f"{row_idx},{col}"] = value
+
+
+def parse_layers_dump(text: str) -> dict[str, Any]:
+    """Parse the output of ``vitaly -i <id> layers -p`` into a state (without macros).
+
+    Each layer starts with a 'Layer N' header followed by a box-drawn grid of
+    keys. Cells may carry an explicit 'row,col' label; otherwise the position
+    is taken from the cell's place in the grid. Encoder lines look like
+    'Encoder 0: ccw=KC_VOLD cw=KC_VOLU'.
+    """
+    state = empty_state()
+    layer = None
+    band: list[list[str]] = []
+    row_idx = 0
+
+    def flush() -> None:
+        nonlocal band, row_idx
+        if band:
+            _flush_row(band, row_idx, _layer_state(state, layer if layer is not None else 0)['keys'])
+            row_idx += 1
+            band = []
+
+    for line in text.splitlines():
+        stripped = line.strip()
+
+        layer_match = _LAYER_RE.match(stripped)
+        if layer_match:
+            flush()
+            layer = int(layer_match.group(1))
+            _layer_state(state, layer)
+            row_idx = 0
+            continue
+
+        encoder_match = _ENCODER_RE.match(stripped)
+        if encoder_match:
+            flush()
+            encoders = _layer_state(state, layer if layer is not None else 0)['encoders']
+            for direction, value in _DIRECTION_RE.findall(stripped):
+                dir_idx = 1 if direction.lower() == 'cw' else 0
+                # Keycodes like LT(1,KC_A) contain commas; only a trailing one separates fields
+                encoders[f"{encoder_match.group(1)},{dir_idx}"] = value.rstrip(',')
+            continue
+
+        if _CELL_SEPARATOR_RE.search(stripped):
+            cells = _CELL_SEPARATOR_RE.split(stripped)
+            # Drop the text outside the outer frame
+            band.append(cells[1:-1])
+        else:
+            # Borders and blank lines separate physical rows
+            flush()
+
+    flush()
+    return state
+
+
+def parse_device_serial(text: str, device_id: int) -> str | None:
+    """Find the serial of a device in the output of ``vitaly devices``."""
+    id_re = re.compile(rf'\b{device_id}\b')
+    lines = text.splitlines()
+    for i, line in enumerate(lines):
+        if not id_re.search(line):
+            continue
+        # The serial is on the device's line or in the block right below it,
+        # which ends at a blank line or at the next device's id field
+        for j, candidate in enumerate(lines[i:]):
+            if j and (not candidate.strip() or _DEVICE_FIELD_RE.search(candidate)):
+                break
+            match = _SERIAL_RE.search(candidate)
+            if match:
+                return match.group(1) or match.group(2)
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Snapshot storage
+# ---------------------------------------------------------------------------
+
+def snapshot_path(state_dir: Path, serial: str) -> Path:
+    """Return the snapshot file for a device serial."""
+    return state_dir / (re.sub(r'[^A-Za-z0-9_.-]', '_', serial) + '.json')
+
+
+def _read_snapshot(path: Path) -> dict[str, Any]:
+    with open(path) as f:
+        try:
+            return json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Corrupt snapshot {path}: {e}") from e
+
+
+def load_snapshot(state_dir: Path, serial: str) -> dict[str, Any] | None:
+    """Load the snapshot for a serial, or None if the device was never deployed."""
+    path = snapshot_path(state_dir, serial)
+    if not path.exists():
+        return None
+    return _read_snapshot(path)
+
+
+def save_snapshot(state_dir: Path, serial: str, device_id: int, state: dict[str, Any]) -> Path:
+    """Write the snapshot for a serial and return its path."""
+    state_dir.mkdir(parents=True, exist_ok=True)
+    snapshot = {
+        'serial': serial,
+        'device_id': device_id,
+        'updated': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'layers': state['layers'],
+        'macros': state['macros'],
+    }
+    path = snapshot_path(state_dir, serial)
+    with open(path, 'w') as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+        f.write("\n")
+    return path
+
+
+def merge_states(base: dict[str, Any], update: dict[str, Any]) -> dict[str, Any]:
+    """Return base with every entry of update applied on top of it."""
+    merged = json.loads(json.dumps({'layers': base['layers'], 'macros': base['macros']}))
+    for layer_idx, layer in update['layers'].items():
+        merged_layer = _layer_state(merged, layer_idx)
+        for kind in ['keys', 'encoders']:
+            merged_layer[kind].update(layer.get(kind, {}))
+    merged['macros'].update(update['macros'])
+    return merged
+
+
+# ---------------------------------------------------------------------------
+# Device access
+# ---------------------------------------------------------------------------
+
+def _run_vitaly(args: list[str], timeout: float = VITALY_TIMEOUT) -> str:
+    result = subprocess.run(['vitaly', *args], capture_output=True, text=True, timeout=timeout)
+    if result.returncode != 0:
+        raise RuntimeError(f"vitaly {' '.join(args)} failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+def _snapshot_serials(state_dir: Path, device_id: int) -> list[str]:
+    """Return the serials of all snapshots recorded for device_id."""
+    serials = []
+    for path in sorted(state_dir.glob('*.json')):
+        snapshot = _read_snapshot(path)
+        if snapshot.get('device_id') == device_id:
+            serials.append(snapshot['serial'])
+    return serials
+
+
+def resolve_serial(device_id: int, serial: str | None, state_dir: Path, offline: bool = False) -> str:
+    """Return the serial to key snapshots by.
+
+    Uses the explicit serial if given. Commands that talk to the device ask it
+    first; offline commands (plan, verify without --full) use the only
+    snapshot recorded for device_id and ask the device only when there is no
+    snapshot or more than one.
+    """
+    if serial:
+        return serial
+
+    known = _snapshot_serials(state_dir, device_id)
+    if offline and len(known) == 1:
+        return known[0]
+
+    try:
+        found = parse_device_serial(_run_vitaly(['devices'], timeout=DEVICES_TIMEOUT), device_id)
+    except (OSError, RuntimeError, subprocess.TimeoutExpired):
+        found = None
+    if found:
+        return found
+
+    if len(known) == 1:
+        return known[0]
+
+    raise ValueError(f"Cannot determine serial for device {device_id}; pass --serial")
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+
+def cmd_plan(config: dict[str, Any], serial: str, state_dir: Path) -> int:
+    snapshot = load_snapshot(state_dir, serial)
+    if snapshot is None:
+        print(f"No snapshot for {serial}; every entry will be written.")
+        snapshot = empty_state()
+
+    changes = diff_states(snapshot, config_state(config))
+    if not changes:
+        print(f"Device {serial} is up to date.")
+        return 0
+
+    print(f"Pending changes for {serial}:")
+    print(format_changes(changes))
+    print(f"{len(changes)} change(s) pending.")
+    return 0
+
+
+def cmd_deploy(config: dict[str, Any], serial: str, state_dir: Path) -> int:
+    script = generate_shell_script(generate_macros(config), generate_keys(config), generate_encoders(config), {})
+    # Pass the script as an argument so vitaly cannot consume it from stdin
+    result = subprocess.run(['bash', '-ec', script], text=True)
+    if result.returncode != 0:
+        print(f"Deploy failed (exit {result.returncode}); snapshot not updated.", file=sys.stderr)
+        return result.returncode
+
+    snapshot = load_snapshot(state_dir, serial) or empty_state()
+    path = save_snapshot(state_dir, serial, config['device_id'], merge_states(snapshot, config_state(config)))
+    print(f"Updated: {path}")
+    return 0
+
+
+def cmd_verify(config: dict[str, Any], serial: str, state_dir: Path, full: bool) -> int:
+    snapshot = load_snapshot(state_dir, serial)
+    if snapshot is None and not full:
+        print(f"No snapshot for {serial}; run deploy or verify --full first.", file=sys.stderr)
+        return 1
+    snapshot = snapshot or empty_state()
+
+    if full:
+        device = parse_layers_dump(_run_vitaly(['-i', str(config['device_id']), 'layers', '-p']))
+        if not any(layer['keys'] for layer in device['layers'].values()):
+            print(f"Could not parse the layer dump of {serial}; snapshot not updated.", file=sys.stderr)
+            return 1
+        drift = find_drift(snapshot, device)
+        if drift:
+            print(f"Device {serial} drifted from its snapshot (snapshot -> device):")
+            print(format_drift(drift))
+        # The layer dump carries no macros: keep the recorded ones, but do not
+        # claim they were checked
+        path = save_snapshot(state_dir, serial, config['device_id'], {**device, 'macros': snapshot['macros']})
+        print(f"Updated: {path}")
+        print("Macros are not part of the layer dump and were not checked.")
+        snapshot = device
+
+    desired = config_state(config)
+    if full:
+        desired['macros'] = {}
+    changes = diff_states(snapshot, desired)
+    if changes:
+        print(f"Device {serial} does not match config:")
+        print(format_changes(changes))
+        return 1
+
+    print(f"Device {serial} matches config.")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Plan, deploy and verify macropad configs against device snapshots")
+    parser.add_argument('command', choices=['plan', 'deploy', 'verify'], help="Action to perform")
+    parser.add_argument('config_file', type=Path, help="Path to YAML config file")
+    parser.add_argument('--serial', help="Device serial (default: read from 'vitaly devices')")
+    parser.add_argument('--state-dir', type=Path, default=DEFAULT_STATE_DIR,
+                        help="Directory holding device snapshots")
+    parser.add_argument('--full', action='store_true',
+                        help="verify: re-read the device instead of trusting the snapshot")
+    args = parser.parse_args()
+
+    try:
+        config = load_yaml(args.config_file)
+        validate_config(config)
+        offline = args.command == 'plan' or (args.command == 'verify' and not args.full)
+        serial = resolve_serial(config['device_id'], args.serial, args.state_dir, offline)
+
+        if args.command == 'plan':
+            return cmd_plan(config, serial, args.state_dir)
+        if args.command == 'deploy':
+            return cmd_deploy(config, serial, args.state_dir)
+        return cmd_verify(config, serial, args.state_dir, args.full)
+    except (ValueError, OSError, RuntimeError, subprocess.TimeoutExpired) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,404 @@
+#!/usr/bin/env python3
+"""Unit tests for device_state.py"""
+
+import subprocess
+from pathlib import Path
+
+import pytest
+
+import device_state
+from device_state import (
+    cmd_deploy,
+    cmd_plan,
+    cmd_verify,
+    config_state,
+    diff_states,
+    empty_state,
+    find_drift,
+    format_changes,
+    format_drift,
+    load_snapshot,
+    main,
+    merge_states,
+    normalize_keycode,
+    parse_device_serial,
+    parse_layers_dump,
+    resolve_serial,
+    save_snapshot,
+)
+
+
+# ---------------------------------------------------------------------------
+# parse_layers_dump
+# ---------------------------------------------------------------------------
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+LAYERS_DUMP = (FIXTURES / 'vitaly-layers-p.txt').read_text()
+DEVICES_OUTPUT = (FIXTURES / 'vitaly-devices.txt').read_text()
+
+
+class TestParseLayersDump:
+    def test_layers_found(self):
+        state = parse_layers_dump(LAYERS_DUMP)
+        assert sorted(state['layers']) == ['0', '1']
+
+    def test_labelled_positions(self):
+        keys = parse_layers_dump(LAYERS_DUMP)['layers']['0']['keys']
+        assert keys['0,0'] == 'M0'
+        assert keys['0,3'] == 'KC_ESC'
+        assert keys['1,0'] == 'LCTL(KC_SPC)'
+        assert len(keys) == 8
+
+    def test_grid_positions_without_labels(self):
+        keys = parse_layers_dump(LAYERS_DUMP)['layers']['1']['keys']
+        assert keys == {'0,0': 'KC_A', '0,1': 'KC_B', '1,0': 'KC_C', '1,1': 'KC_TRNS'}
+
+    def test_encoders(self):
+        encoders = parse_layers_dump(LAYERS_DUMP)['layers']['0']['encoders']
+        assert encoders == {'0,0': 'KC_VOLD', '0,1': 'KC_VOLU', '1,0': 'M5', '1,1': 'M6'}
+
+    def test_no_macros(self):
+        assert parse_layers_dump(LAYERS_DUMP)['macros'] == {}
+
+    def test_encoder_keycode_with_comma(self):
+        dump = "Layer 0\nEncoder 2: ccw=LT(1,KC_A), cw=KC_VOLU\n"
+        encoders = parse_layers_dump(dump)['layers']['0']['encoders']
+        assert encoders == {'2,0': 'LT(1,KC_A)', '2,1': 'KC_VOLU'}
+
+    def test_unexpected_output_has_no_keys(self):
+        state = parse_layers_dump("error: device busy\n")
+        assert not any(layer['keys'] for layer in state['layers'].values())
+
+    def test_ascii_pipes(self):
+        dump = "Layer 2\n+------+------+\n| KC_1 | KC_2 |\n+------+------+\n"
+        assert parse_layers_dump(dump)['layers']['2']['keys'] == {'0,0': 'KC_1', '0,1': 'KC_2'}
+
+
+# ---------------------------------------------------------------------------
+# parse_device_serial
+# ---------------------------------------------------------------------------
+
+class TestParseDeviceSerial:
+    def test_serial_on_same_line(self):
+        output = 'Product: KB16-01 id: 5633 serial: "vial:f64c2b3c"\n'
+        assert parse_device_serial(output, 5633) == 'vial:f64c2b3c'
+
+    def test_serial_in_block_below(self):
+        output = "Device id: 1234\n  serial: other\n\nDevice id: 5633\n  serial: vial:abc123\n"
+        assert parse_device_serial(output, 5633) == 'vial:abc123'
+
+    def test_devices_fixture(self):
+        assert parse_device_serial(DEVICES_OUTPUT, 5633) == 'vial:f64c2b3c'
+        assert parse_device_serial(DEVICES_OUTPUT, 1234) == 'vial:0a1b2c3d'
+
+    def test_stops_at_next_device(self):
+        output = "Device id: 5633\nDevice id: 1234 serial: vial:other\n"
+        assert parse_device_serial(output, 5633) is None
+
+    def test_missing_device(self):
+        assert parse_device_serial("Device id: 1234\n  serial: other\n", 5633) is None
+
+
+# ---------------------------------------------------------------------------
+# normalize_keycode
+# ---------------------------------------------------------------------------
+
+class TestNormalizeKeycode:
+    def test_macro_aliases(self):
+        assert normalize_keycode('QK_MACRO_3') == 'M3'
+        assert normalize_keycode('MACRO(3)') == 'M3'
+        assert normalize_keycode('M3') == 'M3'
+
+    def test_transparent_and_no(self):
+        assert normalize_keycode('_______') == 'KC_TRNS'
+        assert normalize_keycode('KC_TRANSPARENT') == 'KC_TRNS'
+        assert normalize_keycode('XXXXXXX') == 'KC_NO'
+
+    def test_modifier_aliases(self):
+        assert normalize_keycode('C(S(KC_C))') == 'LCTL(LSFT(KC_C))'
+        assert normalize_keycode('LCMD(KC_L)') == 'LGUI(KC_L)'
+
+    def test_long_keycode_names(self):
+        assert normalize_keycode('LCTL(KC_SPACE)') == 'LCTL(KC_SPC)'
+        assert normalize_keycode('KC_AUDIO_VOL_UP') == 'KC_VOLU'
+
+    def test_whitespace_and_commas(self):
+        assert normalize_keycode('LT(1, KC_A)') == 'LT(1,KC_A)'
+
+    def test_plain_keycode_unchanged(self):
+        assert normalize_keycode('KC_A') == 'KC_A'
+
+
+# ---------------------------------------------------------------------------
+# config_state / diff_states
+# ---------------------------------------------------------------------------
+
+def _make_config() -> dict:
+    return {
+        'device_id': 5633,
+        'macros': [
+            {'id': 0, 'actions': [{'type': 'tap', 'keycode': 'KC_ESC'}]},
+        ],
+        'layers': [
+            {
+                'index': 0,
+                'keys': [
+                    {'row': 0, 'col': 0, 'value': 'M0'},
+                    {'row': 0, 'col': 1, 'value': 'LCTL(KC_W)'},
+                ],
+                'encoders': [
+                    {'encoder': 0, 'cw': 'KC_VOLU', 'ccw': 'KC_VOLD'},
+                ],
+            }
+        ],
+    }
+
+
+class TestConfigState:
+    def test_entries(self):
+        state = config_state(_make_config())
+        assert state['layers']['0']['keys'] == {'0,0': 'M0', '0,1': 'LCTL(KC_W)'}
+        assert state['layers']['0']['encoders'] == {'0,1': 'KC_VOLU', '0,0': 'KC_VOLD'}
+        assert state['macros'] == {'0': 'Tap(KC_ESC)'}
+
+
+class TestDiffStates:
+    def test_no_changes(self):
+        state = config_state(_make_config())
+        assert diff_states(state, state) == []
+
+    def test_everything_new_against_empty(self):
+        changes = diff_states(empty_state(), config_state(_make_config()))
+        assert len(changes) == 5
+        assert all(old is None for _, _, _, old, _ in changes)
+
+    def test_modified_key(self):
+        current = config_state(_make_config())
+        current['layers']['0']['keys']['0,1'] = 'KC_NO'
+        changes = diff_states(current, config_state(_make_config()))
+        assert changes == [('key', '0', '0,1', 'KC_NO', 'LCTL(KC_W)')]
+
+    def test_extra_device_entries_ignored(self):
+        current = config_state(_make_config())
+        current['layers']['0']['keys']['3,3'] = 'KC_A'
+        assert diff_states(current, config_state(_make_config())) == []
+
+    def test_aliases_are_not_changes(self):
+        current = config_state(_make_config())
+        current['layers']['0']['keys'] = {'0,0': 'QK_MACRO_0', '0,1': 'C(KC_W)'}
+        assert diff_states(current, config_state(_make_config())) == []
+
+    def test_drift_is_snapshot_to_device(self):
+        snapshot = config_state(_make_config())
+        device = {'layers': {'0': {'keys': {'0,0': 'M0', '0,1': 'KC_NO'}, 'encoders': {}}}, 'macros': {}}
+        drift = find_drift(snapshot, device)
+        assert ('key', '0', '0,1', 'LCTL(KC_W)', 'KC_NO') in drift
+        assert ('encoder', '0', '0,0', 'KC_VOLD', None) in drift
+        text = format_drift(drift)
+        assert '  ~ layer 0 key 0,1: LCTL(KC_W) -> KC_NO' in text
+        assert '  - layer 0 encoder 0,0: KC_VOLD (missing on device)' in text
+        assert 'macro' not in text
+
+    def test_format_changes(self):
+        text = format_changes([
+            ('key', '0', '0,1', 'KC_NO', 'LCTL(KC_W)'),
+            ('macro', '', '0', None, 'Tap(KC_ESC)'),
+        ])
+        assert text == "  ~ layer 0 key 0,1: KC_NO -> LCTL(KC_W)\n  + macro 0: Tap(KC_ESC)"
+
+
+# ---------------------------------------------------------------------------
+# Snapshot storage
+# ---------------------------------------------------------------------------
+
+class TestSnapshots:
+    def test_round_trip(self, tmp_path):
+        state = config_state(_make_config())
+        save_snapshot(tmp_path, 'vial:abc', 5633, state)
+        snapshot = load_snapshot(tmp_path, 'vial:abc')
+        assert snapshot['serial'] == 'vial:abc'
+        assert snapshot['device_id'] == 5633
+        assert diff_states(snapshot, state) == []
+
+    def test_missing_snapshot(self, tmp_path):
+        assert load_snapshot(tmp_path, 'vial:abc') is None
+
+    def test_merge_keeps_untouched_entries(self):
+        base = parse_layers_dump(LAYERS_DUMP)
+        merged = merge_states(base, config_state(_make_config()))
+        assert merged['layers']['0']['keys']['0,1'] == 'LCTL(KC_W)'
+        assert merged['layers']['0']['keys']['0,3'] == 'KC_ESC'
+        assert merged['layers']['1'] == base['layers']['1']
+        assert base['layers']['0']['keys']['0,1'] == 'M1'
+
+
+# ---------------------------------------------------------------------------
+# Commands
+# ---------------------------------------------------------------------------
+
+def _fake_run(returncode: int):
+    calls = []
+
+    def run(args, **kwargs):
+        calls.append(args)
+        return subprocess.CompletedProcess(args, returncode)
+
+    return run, calls
+
+
+class TestResolveSerial:
+    def test_explicit_serial(self, tmp_path):
+        assert resolve_serial(5633, 'vial:abc', tmp_path) == 'vial:abc'
+
+    def test_serial_from_device(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: 'id: 5633 serial: vial:dev\n')
+        assert resolve_serial(5633, None, tmp_path) == 'vial:dev'
+
+    def test_falls_back_to_only_snapshot(self, tmp_path, monkeypatch):
+        def stuck(args, timeout=None):
+            raise subprocess.TimeoutExpired(['vitaly', *args], timeout)
+
+        monkeypatch.setattr(device_state, '_run_vitaly', stuck)
+        save_snapshot(tmp_path, 'vial:abc', 5633, empty_state())
+        save_snapshot(tmp_path, 'vial:xyz', 1234, empty_state())
+        assert resolve_serial(5633, None, tmp_path) == 'vial:abc'
+
+    def test_offline_prefers_single_snapshot(self, tmp_path, monkeypatch):
+        def no_device(args, timeout=None):
+            raise AssertionError("must not touch the device")
+
+        monkeypatch.setattr(device_state, '_run_vitaly', no_device)
+        save_snapshot(tmp_path, 'vial:abc', 5633, empty_state())
+        assert resolve_serial(5633, None, tmp_path, offline=True) == 'vial:abc'
+
+    def test_online_asks_device_first(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: DEVICES_OUTPUT)
+        save_snapshot(tmp_path, 'vial:old', 5633, empty_state())
+        assert resolve_serial(5633, None, tmp_path) == 'vial:f64c2b3c'
+
+    def test_ambiguous_snapshots(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: '')
+        save_snapshot(tmp_path, 'vial:abc', 5633, empty_state())
+        save_snapshot(tmp_path, 'vial:def', 5633, empty_state())
+        with pytest.raises(ValueError, match='--serial'):
+            resolve_serial(5633, None, tmp_path)
+
+
+class TestCommands:
+    def test_deploy_success_merges_snapshot(self, tmp_path, monkeypatch):
+        run, calls = _fake_run(0)
+        monkeypatch.setattr(device_state.subprocess, 'run', run)
+        save_snapshot(tmp_path, 'vial:abc', 5633, parse_layers_dump(LAYERS_DUMP))
+
+        assert cmd_deploy(_make_config(), 'vial:abc', tmp_path) == 0
+        # The script is an argument, not stdin, so vitaly cannot swallow it
+        assert len(calls) == 1 and calls[0][:2] == ['bash', '-ec']
+        assert "keys -l 0 -p 0,1 -v 'LCTL(KC_W)'" in calls[0][2]
+        snapshot = load_snapshot(tmp_path, 'vial:abc')
+        assert diff_states(snapshot, config_state(_make_config())) == []
+        assert snapshot['layers']['0']['keys']['0,3'] == 'KC_ESC'
+        assert snapshot['layers']['1']['keys']['0,0'] == 'KC_A'
+
+    def test_deploy_failure_keeps_snapshot(self, tmp_path, monkeypatch):
+        run, _ = _fake_run(3)
+        monkeypatch.setattr(device_state.subprocess, 'run', run)
+        path = save_snapshot(tmp_path, 'vial:abc', 5633, parse_layers_dump(LAYERS_DUMP))
+        before = path.read_text()
+
+        assert cmd_deploy(_make_config(), 'vial:abc', tmp_path) == 3
+        assert path.read_text() == before
+
+    def test_deploy_failure_without_snapshot(self, tmp_path, monkeypatch):
+        run, _ = _fake_run(1)
+        monkeypatch.setattr(device_state.subprocess, 'run', run)
+        assert cmd_deploy(_make_config(), 'vial:abc', tmp_path) == 1
+        assert load_snapshot(tmp_path, 'vial:abc') is None
+
+    def test_plan_lists_changes(self, tmp_path, capsys):
+        save_snapshot(tmp_path, 'vial:abc', 5633, parse_layers_dump(LAYERS_DUMP))
+        assert cmd_plan(_make_config(), 'vial:abc', tmp_path) == 0
+        out = capsys.readouterr().out
+        assert '~ layer 0 key 0,1: M1 -> LCTL(KC_W)' in out
+        assert '+ macro 0: Tap(KC_ESC)' in out
+
+    def test_verify_against_snapshot(self, tmp_path):
+        save_snapshot(tmp_path, 'vial:abc', 5633, config_state(_make_config()))
+        assert cmd_verify(_make_config(), 'vial:abc', tmp_path, full=False) == 0
+
+    def test_verify_full_refreshes_snapshot(self, tmp_path, monkeypatch, capsys):
+        save_snapshot(tmp_path, 'vial:abc', 5633, config_state(_make_config()))
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: LAYERS_DUMP)
+
+        assert cmd_verify(_make_config(), 'vial:abc', tmp_path, full=True) == 1
+        out = capsys.readouterr().out
+        assert 'drifted from its snapshot (snapshot -> device)' in out
+        assert '~ layer 0 key 0,1: LCTL(KC_W) -> M1' in out
+        assert '- layer 0 encoder' not in out
+        assert 'Macros are not part of the layer dump' in out
+        snapshot = load_snapshot(tmp_path, 'vial:abc')
+        assert snapshot['layers'] == parse_layers_dump(LAYERS_DUMP)['layers']
+        assert snapshot['macros'] == {'0': 'Tap(KC_ESC)'}
+
+    def test_verify_full_unparseable_dump_keeps_snapshot(self, tmp_path, monkeypatch, capsys):
+        path = save_snapshot(tmp_path, 'vial:abc', 5633, config_state(_make_config()))
+        before = path.read_text()
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: 'unexpected output\n')
+
+        assert cmd_verify(_make_config(), 'vial:abc', tmp_path, full=True) == 1
+        assert 'Could not parse' in capsys.readouterr().err
+        assert path.read_text() == before
+
+    def test_verify_full_without_snapshot(self, tmp_path, monkeypatch, capsys):
+        dump = "Layer 0\n│ QK_MACRO_0 │ C(KC_W) │\nEncoder 0: ccw=KC_AUDIO_VOL_DOWN cw=KC_AUDIO_VOL_UP\n"
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: dump)
+
+        # Macros cannot be read back, so a correctly flashed device matches
+        assert cmd_verify(_make_config(), 'vial:abc', tmp_path, full=True) == 0
+        out = capsys.readouterr().out
+        assert 'matches config' in out
+        assert 'drifted' not in out
+        assert load_snapshot(tmp_path, 'vial:abc')['macros'] == {}
+
+
+class TestMain:
+    def _run(self, monkeypatch, tmp_path, *args):
+        config = tmp_path / 'config.yaml'
+        config.write_text("device_id: 5633\nlayers:\n  - index: 0\n    keys:\n      - {row: 0, col: 0, value: KC_A}\n")
+        monkeypatch.setattr('sys.argv', ['device_state.py', *args, str(config), '--state-dir', str(tmp_path / 'st')])
+        return main()
+
+    def test_unknown_serial_is_reported(self, tmp_path, monkeypatch, capsys):
+        monkeypatch.setattr(device_state, '_run_vitaly', lambda args, timeout=None: '')
+        assert self._run(monkeypatch, tmp_path, 'plan') == 1
+        assert 'Cannot determine serial' in capsys.readouterr().err
+
+    def test_missing_vitaly_is_reported(self, tmp_path, monkeypatch, capsys):
+        def missing(*args, **kwargs):
+            raise FileNotFoundError("No such file or directory: 'vitaly'")
+
+        monkeypatch.setattr(device_state.subprocess, 'run', missing)
+        assert self._run(monkeypatch, tmp_path, 'verify', '--full', '--serial', 'vial:abc') == 1
+        assert "Error: No such file or directory: 'vitaly'" in capsys.readouterr().err
+
+    def test_vitaly_timeout_is_reported(self, tmp_path, monkeypatch, capsys):
+        def stuck(args, timeout=None):
+            raise subprocess.TimeoutExpired(['vitaly', *args], timeout)
+
+        monkeypatch.setattr(device_state, '_run_vitaly', stuck)
+        assert self._run(monkeypatch, tmp_path, 'verify', '--full', '--serial', 'vial:abc') == 1
+        assert 'timed out' in capsys.readouterr().err
+
+    def test_corrupt_snapshot_is_reported(self, tmp_path, monkeypatch, capsys):
+        (tmp_path / 'st').mkdir()
+        (tmp_path / 'st' / 'bad.json').write_text('{not json')
+        assert self._run(monkeypatch, tmp_path, 'plan') == 1
+        assert 'Corrupt snapshot' in capsys.readouterr().err
+
+    def test_plan_uses_only_snapshot_without_device(self, tmp_path, monkeypatch, capsys):
+        def no_device(args, timeout=None):
+            raise AssertionError("plan must not touch the device")
+
+        monkeypatch.setattr(device_state, '_run_vitaly', no_device)
+        save_snapshot(tmp_path / 'st', 'vial:abc', 5633, empty_state())
+        assert self._run(monkeypatch, tmp_path, 'plan') == 0
+        assert '+ layer 0 key 0,0: KC_A' in capsys.readouterr().out